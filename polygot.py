@@ -1,7 +1,15 @@
 import chess
 import chess.pgn
 import chess.polyglot
-import datetime
+import collections
+import concurrent.futures
+import functools
+import io
+import mmap
+import multiprocessing
+import os
+import re
+import sys
 
 # Maximum number of moves from each game to include in the book
 MAX_BOOK_PLIES = 999
@@ -10,152 +18,241 @@ MAX_BOOK_WEIGHT = 1000000
 # Maximum weight allowed in Polyglot entry (16-bit)
 POLYGLOT_MAX_WEIGHT = 65535
 
-def format_zobrist_key_hex(zobrist_key):
-    return f"{zobrist_key:016x}"
+# Weight added to moves by (black, white) for each game result, indexed by chess.Color
+RESULT_WEIGHTS = {
+    b"1-0": (0, 2),
+    b"1/2-1/2": (1, 1),
+    b"0-1": (2, 0),
+}
+
+# Raw PGN scanning, used to filter games before handing them to python-chess
+# A game starts at its first tag line, after a blank line or at the start of the file
+# (past an optional UTF-8 BOM). Matches end on that tag line's opening bracket.
+GAME_START_RE = re.compile(rb"(?:\A(?:\xef\xbb\xbf)?|\n[ \t\r]*\n)[ \t\r\n]*(?=\[)")
+RESULT_HEADER_RE = re.compile(rb'^\[Result "([^"]*)"\]', re.MULTILINE)
+# Size of the game-aligned PGN byte ranges handed to worker processes
+PGN_CHUNK_SIZE = 1 << 22
+
+# Polyglot random value XORed into the key while white is to move
+POLYGLOT_TURN_KEY = chess.polyglot.POLYGLOT_RANDOM_ARRAY[780]
+
+# Polyglot encodes castling as the king moving onto its own rook
+POLYGLOT_CASTLING_MOVES = {
+    chess.G1 | (chess.E1 << 6): chess.H1 | (chess.E1 << 6),
+    chess.C1 | (chess.E1 << 6): chess.A1 | (chess.E1 << 6),
+    chess.G8 | (chess.E8 << 6): chess.H8 | (chess.E8 << 6),
+    chess.C8 | (chess.E8 << 6): chess.A8 | (chess.E8 << 6),
+}
+
+zobrist_hasher = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+def zobrist_piece_key(piece, square):
+    piece_index = (piece.piece_type - 1) * 2 + piece.color
+    return chess.polyglot.POLYGLOT_RANDOM_ARRAY[64 * piece_index + square]
+
+def zobrist_move_delta(board, move):
+    # XOR change to the piece and turn part of the Polyglot key made by the move,
+    # or None when castling, drops and variant boards need a full rehash instead
+    if type(board) is not chess.Board or not move or move.drop or board.is_castling(move):
+        return None
 
-def get_zobrist_key_hex(board):
-    return format_zobrist_key_hex(chess.polyglot.zobrist_hash(board))
+    piece = board.piece_at(move.from_square)
+    delta = POLYGLOT_TURN_KEY ^ zobrist_piece_key(piece, move.from_square)
 
-class BookMove:
-    def __init__(self):
-        self.weight = 0
-        self.move = None
+    if board.is_en_passant(move):
+        captured_square = move.to_square - 8 if board.turn == chess.WHITE else move.to_square + 8
+        delta ^= zobrist_piece_key(chess.Piece(chess.PAWN, not board.turn), captured_square)
+    else:
+        captured = board.piece_at(move.to_square)
+        if captured:
+            delta ^= zobrist_piece_key(captured, move.to_square)
 
-class BookPosition:
-    def __init__(self):
-        self.moves = {}
-        self.fen = ""
+    if move.promotion:
+        piece = chess.Piece(move.promotion, piece.color)
+    return delta ^ zobrist_piece_key(piece, move.to_square)
 
-    def get_move(self, uci):
-        return self.moves.setdefault(uci, BookMove())
+def encode_polyglot_move(move):
+    mi = move.to_square | (move.from_square << 6)
+    if move.promotion:
+        mi |= (move.promotion - 1) << 12
+    return mi
 
 class Book:
     def __init__(self):
-        self.positions = {}
-
-    def get_position(self, zobrist_key_hex):
-        return self.positions.setdefault(zobrist_key_hex, BookPosition())
+        # Zobrist key << 16 | Polyglot move -> weight
+        self.weights = collections.defaultdict(int)
 
     def normalize_weights(self):
-        for pos in self.positions.values():
-            total_weight = sum(bm.weight for bm in pos.moves.values())
-            if total_weight > 0:
-                for bm in pos.moves.values():
-                    bm.weight = int(bm.weight / total_weight * MAX_BOOK_WEIGHT)
-                    if bm.weight < 1:
-                        bm.weight = 1
+        total_weights = collections.defaultdict(int)
+        for entry, weight in self.weights.items():
+            total_weights[entry >> 16] += weight
+
+        for entry, weight in self.weights.items():
+            total_weight = total_weights[entry >> 16]
+            if total_weight <= 0:
+                continue
+            self.weights[entry] = max(weight * MAX_BOOK_WEIGHT // total_weight, 1)
 
     def save_as_polyglot(self, path):
         with open(path, 'wb') as outfile:
             entries = []
 
-            for key_hex, pos in self.positions.items():
-                zbytes = bytes.fromhex(key_hex)
-
-                for uci, bm in pos.moves.items():
-                    if bm.weight <= 0:
-                        continue
-
-                    move = bm.move
-                    mi = move.to_square + (move.from_square << 6)
-                    if move.promotion:
-                        mi += ((move.promotion - 1) << 12)
-
-                    mbytes = mi.to_bytes(2, byteorder="big")
-
-                    weight = min(max(bm.weight, 1), POLYGLOT_MAX_WEIGHT)
-                    wbytes = weight.to_bytes(2, byteorder="big")
+            for entry, weight in self.weights.items():
+                if weight <= 0:
+                    continue
 
-                    lbytes = (0).to_bytes(4, byteorder="big")
+                weight = min(weight, POLYGLOT_MAX_WEIGHT)
+                # Packed so that a plain int sort orders by key, weight, move
+                entries.append(((entry >> 16) << 32) | (weight << 16) | (entry & 0xffff))
 
-                    entry = zbytes + mbytes + wbytes + lbytes
-                    entries.append(entry)
+            entries.sort()
 
-            entries.sort(key=lambda e: (e[:8], e[10:12]), reverse=False)
+            entry_size = chess.polyglot.ENTRY_STRUCT.size
+            pack_into = chess.polyglot.ENTRY_STRUCT.pack_into
+            buffer = bytearray(len(entries) * entry_size)
+            for i, entry in enumerate(entries):
+                pack_into(buffer, i * entry_size, entry >> 32, entry & 0xffff, (entry >> 16) & 0xffff, 0)
 
-            for entry in entries:
-                outfile.write(entry)
+            outfile.write(buffer)
 
             print(f"Saved {len(entries)} moves to book: {path}")
 
-    def merge_file(self, path):
-        with chess.polyglot.open_reader(path) as reader:
-            for i, entry in enumerate(reader, start=1):
-                key_hex = format_zobrist_key_hex(entry.key)
-                pos = self.get_position(key_hex)
-                move = entry.move()
-                uci = move.uci()
-
-                bm = pos.get_move(uci)
-                bm.move = move
-                bm.weight += entry.weight
+    def merge(self, other):
+        for entry, weight in other.weights.items():
+            self.weights[entry] += weight
 
-                if i % 10000 == 0:
-                    print(f"Merged {i} moves")
-
-class LichessGame:
-    def __init__(self, game):
-        self.game = game
-
-    def get_id(self):
-        return self.game.headers["Site"].split("/")[-1]
-
-    def get_time(self):
-        dt_str = self.game.headers["UTCDate"] + "T" + self.game.headers["UTCTime"]
-        return datetime.datetime.strptime(dt_str, "%Y.%m.%dT%H:%M:%S").timestamp()
+    def merge_file(self, path):
+        with open(path, "rb") as book_file:
+            data = book_file.read()
+
+        # A trailing partial record is ignored, as chess.polyglot.open_reader does
+        entry_size = chess.polyglot.ENTRY_STRUCT.size
+        entries = chess.polyglot.ENTRY_STRUCT.iter_unpack(data[:len(data) - len(data) % entry_size])
+        for i, (zobrist_key, mi, weight, _) in enumerate(entries, start=1):
+            self.weights[(zobrist_key << 16) | mi] += weight
+
+            if i % 10000 == 0:
+                print(f"Merged {i} moves")
+
+class BookVisitor(chess.pgn.BaseVisitor):
+    # Adds mainline moves to the book straight from the PGN reader's board,
+    # without building a game tree or replaying the moves on a second board
+    def __init__(self, book, result_weights):
+        self.book = book
+        self.result_weights = result_weights
+
+    def begin_game(self):
+        self.ply = 0
+        self.ply_weights = None
+        self.pieces_key = None
+        self.castling_rights = None
+        self.castling_key = 0
+
+    def visit_board(self, board):
+        # Called for the starting position and after every move
+        if self.ply_weights is None:
+            # Plies alternate sides, starting with the side to move in the initial position
+            self.ply_weights = (self.result_weights[board.turn], self.result_weights[not board.turn])
+        if self.pieces_key is None:
+            self.pieces_key = zobrist_hasher.hash_board(board) ^ zobrist_hasher.hash_turn(board)
+
+    def begin_parse_san(self, board, san):
+        # Moves past the book depth are not even parsed
+        if self.ply >= MAX_BOOK_PLIES:
+            return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        mi = polyglot_move(board, move)
+        if mi is not None:
+            if board.castling_rights != self.castling_rights:
+                self.castling_rights = board.castling_rights
+                self.castling_key = zobrist_hasher.hash_castling(board)
+
+            zobrist_key = self.pieces_key ^ self.castling_key ^ zobrist_hasher.hash_ep_square(board)
+            self.book.weights[(zobrist_key << 16) | mi] += self.ply_weights[self.ply & 1]
+
+        delta = zobrist_move_delta(board, move)
+        self.pieces_key = None if delta is None else self.pieces_key ^ delta
+        self.ply += 1
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def handle_error(self, error):
+        chess.pgn.LOGGER.error("%s while parsing game", error)
 
     def result(self):
-        return self.game.headers.get("Result", "*")
-
-    def score(self):
-        res = self.result()
-        return {"1-0": 2, "1/2-1/2": 1}.get(res, 0)
+        return self.book
 
-def correct_castling_uci(uci, board):
-    if len(uci) < 4 or "@" in uci:
+def polyglot_move(board, move):
+    # Polyglot has no encoding for null moves or drops
+    if not move or move.drop:
         return None
-    piece = board.piece_at(chess.parse_square(uci[:2]))
-    if piece and piece.piece_type == chess.KING:
-        if uci == "e1g1": return "e1h1"
-        if uci == "e1c1": return "e1a1"
-        if uci == "e8g8": return "e8h8"
-        if uci == "e8c8": return "e8a8"
-    return uci
-
-def build_book_file(pgn_path, book_path):
+    mi = encode_polyglot_move(move)
+    if mi in POLYGLOT_CASTLING_MOVES and board.piece_type_at(move.from_square) == chess.KING:
+        return POLYGLOT_CASTLING_MOVES[mi]
+    return mi
+
+def iter_game_spans(data, start, end):
+    # Anything before the first tag line belongs to the first game, as read_game would see it
+    game_start = start
+    for match in GAME_START_RE.finditer(data, start, end):
+        if match.start() > game_start:
+            yield game_start, match.end()
+        game_start = match.end()
+    if game_start < end:
+        yield game_start, end
+
+def iter_pgn_chunks(data, chunk_size):
+    start = 0
+    while start < len(data):
+        match = GAME_START_RE.search(data, start + chunk_size)
+        end = match.end() if match else len(data)
+        yield start, end
+        start = end
+
+def build_book_chunk(pgn_path, start, end):
     book = Book()
-    with open(pgn_path, encoding="utf-8", errors="ignore") as pgn_file:
-        for i, game in enumerate(iter(lambda: chess.pgn.read_game(pgn_file), None), start=1):
-            if i % 100 == 0:
-                print(f"Processed {i} games from {pgn_path}")
-
-            ligame = LichessGame(game)
+    games = 0
+    with open(pgn_path, "rb") as pgn_file, mmap.mmap(pgn_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for game_start, game_end in iter_game_spans(data, start, end):
+            games += 1
 
-            if ligame.result() != "1/2-1/2":
+            result = RESULT_HEADER_RE.search(data, game_start, game_end)
+            if not result or result.group(1) != b"1/2-1/2":
                 continue
 
-            board = game.board()
-            score = ligame.score()
-            ply = 0
-
-            for move in game.mainline_moves():
-                if ply >= MAX_BOOK_PLIES:
-                    break
+            pgn_text = data[game_start:game_end].decode("utf-8", errors="ignore")
+            visitor = functools.partial(BookVisitor, book, RESULT_WEIGHTS[result.group(1)])
+            chess.pgn.read_game(io.StringIO(pgn_text), Visitor=visitor)
 
-                uci = correct_castling_uci(move.uci(), board)
-                if not uci:
-                    board.push(move)
-                    ply += 1
-                    continue
+    return games, book
 
-                zobrist_key_hex = get_zobrist_key_hex(board)
-                position = book.get_position(zobrist_key_hex)
-                bm = position.get_move(uci)
-                bm.move = chess.Move.from_uci(uci)
-                bm.weight += score if board.turn == chess.WHITE else (2 - score)
+def build_book_file(pgn_path, book_path):
+    # An empty PGN cannot be memory-mapped, and has no games to hand out anyway
+    chunks = []
+    if os.path.getsize(pgn_path) > 0:
+        with open(pgn_path, "rb") as pgn_file, mmap.mmap(pgn_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunks = list(iter_pgn_chunks(data, PGN_CHUNK_SIZE))
 
-                board.push(move)
-                ply += 1
+    book = Book()
+    games = 0
+    # Forked workers inherit the already imported chess and Polyglot tables. Only on
+    # Linux: macOS defaults to spawn because forked children can crash there.
+    start_method = "fork" if sys.platform.startswith("linux") else None
+    with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context(start_method)) as executor:
+        # as_completed drops each future once yielded, so merged partial books can be freed
+        futures = concurrent.futures.as_completed([
+            executor.submit(build_book_chunk, pgn_path, start, end) for start, end in chunks
+        ])
+        for future in futures:
+            chunk_games, chunk_book = future.result()
+            # Fold the smaller book into the larger one instead of copying both
+            if len(chunk_book.weights) > len(book.weights):
+                book, chunk_book = chunk_book, book
+            book.merge(chunk_book)
+            games += chunk_games
+            print(f"Processed {games} games from {pgn_path}")
 
     book.normalize_weights()
     book.save_as_polyglot(book_path)